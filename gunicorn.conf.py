@@ -0,0 +1,36 @@
+# Gunicorn settings for serving tax_analyzer_backend:app (e.g. `gunicorn tax_analyzer_backend:app`).
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '10000')}"
+# A small fixed default: each worker holds its own DB pool, so the worker count is bounded by
+# the connection budget below rather than by the host's CPU count.
+workers = int(os.environ.get("WEB_CONCURRENCY", "2"))
+threads = int(os.environ.get("GUNICORN_THREADS", "8"))
+worker_class = "gthread"
+# Gemini calls can legitimately take close to a minute.
+timeout = 120
+
+# Import the app once in the master so workers inherit the Session, PasswordHasher and the
+# shared-memory Gemini token bucket copy-on-write, instead of each building its own.
+preload_app = True
+# Every worker has its own parse pool. Two processes each keep the total near twice the worker
+# count while one slow PDF (up to PDF_PARSE_TIMEOUT) does not stall the worker's other uploads.
+os.environ.setdefault("PDF_PARSE_PROCESSES", "2")
+# Every worker also has its own DB pool, and together they must fit PostgreSQL's
+# max_connections. DB_MAX_CONNECTIONS is this service's share of it (leave headroom for
+# migrations and admin sessions); each worker gets an equal slice, at most one per thread.
+# A slice smaller than the thread count is fine: request threads queue for a free connection.
+db_max_connections = int(os.environ.get("DB_MAX_CONNECTIONS", "20"))
+if workers > db_max_connections:
+    raise RuntimeError(f"WEB_CONCURRENCY={workers} exceeds DB_MAX_CONNECTIONS={db_max_connections}.")
+os.environ["DB_POOL_MAX"] = str(min(int(os.environ.get("DB_POOL_MAX", threads)), threads,
+                                    db_max_connections // workers))
+# Idle connections beyond DB_POOL_MIN are closed on return, so keep the whole slice open.
+os.environ.setdefault("DB_POOL_MIN", os.environ["DB_POOL_MAX"])
+
+
+def when_ready(server):
+    # Runs in the master before workers fork: drop any connections opened while preloading
+    # so no worker inherits a live PostgreSQL socket. Workers open their own pools lazily.
+    import tax_analyzer_backend
+    tax_analyzer_backend.close_db_pool()
@@ -0,0 +1,71 @@
+# --- Part 2: Database Migrations (migrate.py) ---
+# Run once per deploy, before the web workers start (e.g. Render's pre-deploy command):
+#     python -m migrate
+# The web app only applies them itself when started with RUN_MIGRATIONS=1.
+
+import os
+import sys
+import psycopg2
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# --- Database Connection Details (from Environment Variables) ---
+DB_HOST = os.getenv("DB_HOST")
+DB_PORT = os.getenv("DB_PORT")
+DB_USER = os.getenv("DB_USER")
+DB_PASSWORD = os.getenv("DB_PASSWORD")
+DB_NAME = os.getenv("DB_NAME")
+DB_SSL_MODE = os.getenv("DB_SSL_MODE", "require")
+
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "migrations")
+
+# Records which files have run, so each deploy only applies new ones.
+SCHEMA_MIGRATIONS_TABLE = """
+CREATE TABLE IF NOT EXISTS schema_migrations (
+    filename VARCHAR(255) PRIMARY KEY,
+    applied_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
+);
+"""
+
+def run_migrations():
+    """Applies new migrations/*.sql files in name order, one transaction per file."""
+    if not all([DB_HOST, DB_PORT, DB_USER, DB_PASSWORD, DB_NAME]):
+        print("FATAL ERROR: Database environment variables are not fully set.")
+        return False
+    try:
+        conn = psycopg2.connect(
+            host=DB_HOST, port=DB_PORT, user=DB_USER,
+            password=DB_PASSWORD, dbname=DB_NAME, sslmode=DB_SSL_MODE
+        )
+    except psycopg2.Error as e:
+        print(f"DATABASE CONNECTION FAILED: {e}")
+        return False
+
+    try:
+        with conn.cursor() as cur:
+            cur.execute(SCHEMA_MIGRATIONS_TABLE)
+        conn.commit()
+        for name in sorted(f for f in os.listdir(MIGRATIONS_DIR) if f.endswith(".sql")):
+            with conn.cursor() as cur:
+                # Held until commit, so a concurrent deploy waits and then sees this file as applied.
+                cur.execute("LOCK TABLE schema_migrations IN EXCLUSIVE MODE;")
+                cur.execute("SELECT 1 FROM schema_migrations WHERE filename = %s;", (name,))
+                if cur.fetchone():
+                    conn.rollback()
+                    continue
+                with open(os.path.join(MIGRATIONS_DIR, name)) as f:
+                    cur.execute(f.read())
+                cur.execute("INSERT INTO schema_migrations (filename) VALUES (%s);", (name,))
+            conn.commit()
+            print(f"Applied migration {name}.")
+        print("Database schema verified successfully.")
+        return True
+    except psycopg2.Error as e:
+        print(f"DATABASE SCHEMA ERROR: {e}")
+        return False
+    finally:
+        conn.close()
+
+if __name__ == '__main__':
+    sys.exit(0 if run_migrations() else 1)
@@ -0,0 +1,18 @@
+-- Initial schema. Every statement is idempotent so the file is safe to re-run.
+
+CREATE TABLE IF NOT EXISTS users (
+    id SERIAL PRIMARY KEY,
+    first_name VARCHAR(100) NOT NULL,
+    last_name VARCHAR(100) NOT NULL,
+    email VARCHAR(255) UNIQUE NOT NULL,
+    password_hash VARCHAR(255) NOT NULL,
+    created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
+    dob DATE,
+    mobile_number VARCHAR(25)
+);
+
+CREATE TABLE IF NOT EXISTS summaries (
+    pdf_hash VARCHAR(32) PRIMARY KEY,
+    summary JSONB NOT NULL,
+    created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
+);
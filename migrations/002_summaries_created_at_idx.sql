@@ -0,0 +1,3 @@
+-- Cached summaries expire by age; this index serves the TTL filter and the periodic purge.
+
+CREATE INDEX IF NOT EXISTS summaries_created_at_idx ON summaries (created_at);
@@ -0,0 +1,16 @@
+-- Emails are matched case-insensitively. Older schemas allowed addresses differing only in case,
+-- which would make the unique index fail; stop with a clear message so they can be merged first.
+
+DO $$
+DECLARE
+    duplicates INTEGER;
+BEGIN
+    SELECT count(*) INTO duplicates
+    FROM (SELECT 1 FROM users GROUP BY lower(email) HAVING count(*) > 1) AS d;
+    IF duplicates > 0 THEN
+        RAISE EXCEPTION 'users has % email(s) registered more than once with different case; merge them and re-run migrations.', duplicates
+            USING HINT = 'SELECT lower(email) FROM users GROUP BY 1 HAVING count(*) > 1;';
+    END IF;
+END $$;
+
+CREATE UNIQUE INDEX IF NOT EXISTS users_email_lower_idx ON users (lower(email));
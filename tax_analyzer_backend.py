@@ -2,18 +2,62 @@
 # This file should be in your GitHub repository connected to Render.
 
 import os
+import hashlib
+import multiprocessing
+import queue
+import weakref
+import random
+import threading
+import time
+from concurrent.futures import CancelledError, Future, ProcessPoolExecutor, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import contextmanager
 import psycopg2
-from psycopg2.extras import RealDictCursor
+import psycopg2.extensions
+from psycopg2.extras import RealDictCursor, Json
+from psycopg2.pool import ThreadedConnectionPool
+from decimal import Decimal
 from flask import Flask, request, jsonify
+from flask.json.provider import JSONProvider
 from flask_cors import CORS
-from werkzeug.security import generate_password_hash, check_password_hash
+from werkzeug.middleware.proxy_fix import ProxyFix
+from werkzeug.security import check_password_hash
+from argon2 import PasswordHasher
+from argon2.exceptions import InvalidHashError, VerificationError
+from cachetools import TLRUCache, TTLCache
 import fitz
-import requests
-import json
+import httpx
+import orjson
 from dotenv import load_dotenv
+from migrate import run_migrations
+
+def orjson_default(obj):
+    """Serializes the few types orjson does not handle natively."""
+    if isinstance(obj, Decimal):
+        return str(obj)
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+class OrjsonProvider(JSONProvider):
+    """Routes jsonify() and request.get_json() through orjson instead of the stdlib json module."""
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, default=orjson_default).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(orjson.dumps(obj, default=orjson_default), mimetype="application/json")
 
 load_dotenv()
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
+# Render terminates TLS in front of the app; trust its X-Forwarded-For so remote_addr is the client.
+app.wsgi_app = ProxyFix(app.wsgi_app, x_for=int(os.getenv("TRUSTED_PROXY_HOPS", "1")))
+# Uploads larger than this are rejected before they are buffered.
+MAX_PDF_BYTES = int(os.getenv("MAX_PDF_BYTES", str(25 * 1024 * 1024)))
+app.config['MAX_CONTENT_LENGTH'] = MAX_PDF_BYTES
 CORS(app)
 
 # --- Database Connection Details (from Environment Variables) ---
@@ -23,125 +67,673 @@ DB_USER = os.getenv("DB_USER")
 DB_PASSWORD = os.getenv("DB_PASSWORD")
 DB_NAME = os.getenv("DB_NAME")
 DB_SSL_MODE = os.getenv("DB_SSL_MODE", "require")
+# Pools are per process, so the deployment holds up to (gunicorn workers x DB_POOL_MAX)
+# connections; gunicorn.conf.py derives DB_POOL_MAX from the DB_MAX_CONNECTIONS budget.
+DB_POOL_MAX = int(os.getenv("DB_POOL_MAX", "10"))
+# putconn closes a returned connection once DB_POOL_MIN are idle, so a minimum below the maximum
+# reopens (and re-prepares) connections under load; keep every one by default.
+DB_POOL_MIN = min(int(os.getenv("DB_POOL_MIN", str(DB_POOL_MAX))), DB_POOL_MAX)
+# getconn raises rather than waits when every connection is out, so checkouts take a slot here
+# first; when the budget leaves fewer connections than threads, requests queue instead of failing.
+DB_POOL_SLOTS = threading.BoundedSemaphore(DB_POOL_MAX)
+DB_POOL_TIMEOUT = int(os.getenv("DB_POOL_TIMEOUT", "10"))
+
+# Server-side prepared statements for the hot auth queries, created once per pooled connection
+# so each login/register skips parsing and planning. Run through plain tuple cursors.
+PREPARED_STATEMENTS = [
+    "PREPARE login_select (text) AS "
+    "SELECT id, first_name, email, password_hash FROM users WHERE lower(email) = $1",
+    "PREPARE register_insert (text, text, text, text, date, text) AS "
+    "INSERT INTO users (first_name, last_name, email, password_hash, dob, mobile_number) "
+    "VALUES ($1, $2, $3, $4, $5, $6) ON CONFLICT DO NOTHING RETURNING id, first_name, email",
+]
+PREPARED_CONNECTIONS = weakref.WeakSet()
+
+# --- Password Hashing ---
+# argon2id at the OWASP baseline (19 MiB, 2 passes, 1 lane). Legacy Werkzeug pbkdf2 hashes, and
+# hashes made with other parameters, are upgraded on the next successful login.
+PH = PasswordHasher(
+    time_cost=int(os.getenv("ARGON2_TIME_COST", "2")),
+    memory_cost=int(os.getenv("ARGON2_MEMORY_COST", "19456")),
+    parallelism=int(os.getenv("ARGON2_PARALLELISM", "1"))
+)
+# Verified against when the email is unknown, so a miss costs the same as a wrong password.
+DUMMY_HASH = PH.hash("invalid")
+# Failed logins per client IP; past the limit /login answers 429 without running a verify.
+LOGIN_MAX_FAILURES = int(os.getenv("LOGIN_MAX_FAILURES", "10"))
+LOGIN_FAILURE_WINDOW = int(os.getenv("LOGIN_FAILURE_WINDOW", "60"))
+LOGIN_FAILURES = TTLCache(maxsize=10000, ttl=LOGIN_FAILURE_WINDOW)
+LOGIN_FAILURES_LOCK = threading.Lock()
+
+# --- Summary Cache ---
+# Per-process LRU/TTL layer in front of the summaries table; repeat uploads skip even the DB.
+# Summaries hold taxpayer PII, so stored rows expire after the same TTL as this layer.
+SUMMARY_CACHE_TTL = int(os.getenv("SUMMARY_CACHE_TTL", "86400"))
+# Entries are (summary, expires_at) so a row read back from the DB only lives out its remaining
+# TTL here, rather than a fresh one.
+SUMMARY_CACHE = TLRUCache(maxsize=int(os.getenv("SUMMARY_CACHE_SIZE", "1024")),
+                          ttu=lambda key, entry, now: entry[1])
+SUMMARY_CACHE_LOCK = threading.Lock()
+# Expired rows are deleted from the write path, at most once per interval per process.
+SUMMARY_PURGE_INTERVAL = int(os.getenv("SUMMARY_PURGE_INTERVAL", "3600"))
+SUMMARY_LAST_PURGE = 0.0
+
+# --- PDF Extraction ---
+# Notices are a few pages; the cap bounds parse time and the prompt size sent to Gemini.
+MAX_PDF_PAGES = int(os.getenv("MAX_PDF_PAGES", "30"))
+# PyMuPDF's default text flags, with ligatures expanded to ordinary characters.
+PDF_TEXT_FLAGS = fitz.TEXTFLAGS_TEXT & ~fitz.TEXT_PRESERVE_LIGATURES
+# Below this much text the PDF is a scan or empty; Gemini would only return an unusable summary.
+MIN_PDF_TEXT_CHARS = int(os.getenv("MIN_PDF_TEXT_CHARS", "200"))
+# Parsing runs in a process pool so CPU-bound MuPDF work never competes with request threads.
+PDF_PARSE_PROCESSES = int(os.getenv("PDF_PARSE_PROCESSES", str(os.cpu_count() or 1)))
+PDF_PARSE_TIMEOUT = int(os.getenv("PDF_PARSE_TIMEOUT", "60"))
+# Created lazily in each serving process, never inherited across a fork.
+PARSE_POOL = None
+PARSE_POOL_LOCK = threading.Lock()
 
 # --- Gemini API Details (from Environment Variables) ---
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY", "")
 GEMINI_API_URL = f"https://generativelanguage.googleapis.com/v1beta/models/gemini-1.5-flash:generateContent?key={GEMINI_API_KEY}"
+# Roughly 30k tokens; keeps prompts under Gemini's input cap and the TPM estimate honest.
+MAX_PROMPT_CHARS = int(os.getenv("MAX_PROMPT_CHARS", "120000"))
+# Caps in-flight Gemini calls per process so bursts queue here instead of fanning out to the API.
+GEMINI_MAX_CONCURRENCY = int(os.getenv("GEMINI_MAX_CONCURRENCY", "8"))
+GEMINI_SEMAPHORE = threading.BoundedSemaphore(GEMINI_MAX_CONCURRENCY)
+# Quotas default to the gemini-1.5-flash free tier; raise them for paid projects.
+GEMINI_RPM = int(os.getenv("GEMINI_RPM", "15"))
+GEMINI_TPM = int(os.getenv("GEMINI_TPM", "1000000"))
+GEMINI_MAX_ATTEMPTS = 3
+GEMINI_RETRYABLE_STATUSES = (429, 500, 502, 503, 504)
+# Micro-batching: with GEMINI_BATCH_SIZE > 1, uploads arriving within the window share one
+# Gemini call, trading a little latency for throughput under the RPM cap. Off by default.
+# Every summary in a batch shares one reply's 8192 output tokens, so the size is capped.
+GEMINI_BATCH_MAX_SIZE = 4
+GEMINI_BATCH_SIZE = min(int(os.getenv("GEMINI_BATCH_SIZE", "1")), GEMINI_BATCH_MAX_SIZE)
+GEMINI_BATCH_WINDOW = int(os.getenv("GEMINI_BATCH_WINDOW_MS", "150")) / 1000
+# Longer notices are always sent on their own.
+GEMINI_BATCH_MAX_CHARS = int(os.getenv("GEMINI_BATCH_MAX_CHARS", "20000"))
+GEMINI_MAX_BACKOFF = 30
+# Longest a request waits for rate-limit budget before answering 503; past this the client
+# and proxy have usually given up, and a late call would only spend quota for nobody.
+GEMINI_MAX_QUEUE_WAIT = int(os.getenv("GEMINI_MAX_QUEUE_WAIT", "20"))
 
-def get_db_connection():
-    """Establishes a secure connection to the PostgreSQL database."""
+class TokenBucket:
+    """Proactively throttles calls to stay within requests- and tokens-per-minute quotas.
+
+    State lives in shared memory, so a bucket created before Gunicorn forks its workers
+    (preload_app) enforces one quota across all of them.
+    """
+
+    def __init__(self, rpm, tpm):
+        self.rpm = rpm
+        self.tpm = tpm
+        # [available requests, available tokens, last refill time]
+        self._state = multiprocessing.RawArray('d', [float(rpm), float(tpm), time.monotonic()])
+        self._lock = multiprocessing.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        elapsed = now - self._state[2]
+        self._state[2] = now
+        self._state[0] = min(self.rpm, self._state[0] + elapsed * self.rpm / 60)
+        self._state[1] = min(self.tpm, self._state[1] + elapsed * self.tpm / 60)
+
+    def acquire(self, tokens=1, max_wait=None):
+        """Blocks until one request carrying `tokens` tokens fits within both quotas.
+
+        Returns False instead of blocking past `max_wait` seconds; nothing is consumed then.
+        """
+        tokens = min(tokens, self.tpm)
+        deadline = None if max_wait is None else time.monotonic() + max_wait
+        while True:
+            with self._lock:
+                self._refill()
+                if self._state[0] >= 1 and self._state[1] >= tokens:
+                    self._state[0] -= 1
+                    self._state[1] -= tokens
+                    return True
+                wait = max((1 - self._state[0]) * 60 / self.rpm,
+                           (tokens - self._state[1]) * 60 / self.tpm)
+            if deadline is not None and time.monotonic() + wait > deadline:
+                return False
+            time.sleep(wait)
+
+GEMINI_BUCKET = TokenBucket(rpm=GEMINI_RPM, tpm=GEMINI_TPM)
+# Connect and read timeouts, so a hung Gemini never pins a worker indefinitely.
+GEMINI_TIMEOUT = httpx.Timeout(60.0, connect=5.0)
+
+# Structured output: Gemini returns bare JSON in this shape, with no markdown fences to strip.
+# The field descriptions carry the extraction guidance, so the prompt need not repeat the shape.
+GEMINI_RESPONSE_SCHEMA = {
+    "type": "OBJECT",
+    "properties": {
+        "noticeType": {"type": "STRING", "description": "The notice code, like 'CP23' or 'CP503C'."},
+        "noticeFor": {"type": "STRING", "description": "The full name of the taxpayer, e.g., 'JAMES & KAREN Q. HINDS'."},
+        "address": {"type": "STRING", "description": "The full address of the taxpayer, with newlines as \\n, e.g., '22 BOULDER STREET\\nHANSON, CT 00000-7253'."},
+        "ssn": {"type": "STRING", "description": "The Social Security Number, masked, e.g., 'nnn-nn-nnnn'."},
+        "amountDue": {"type": "STRING", "description": "The final total amount due, e.g., '$500.73'."},
+        "payBy": {"type": "STRING", "description": "The payment due date, e.g., 'February 20, 2018'."},
+        "breakdown": {
+            "type": "ARRAY",
+            "description": "Each line item in the billing summary, in order.",
+            "items": {
+                "type": "OBJECT",
+                "properties": {
+                    "item": {"type": "STRING", "description": "The line item's label."},
+                    "amount": {"type": "STRING", "description": "Its corresponding amount."}
+                },
+                "required": ["item", "amount"]
+            }
+        },
+        "noticeMeaning": {"type": "STRING", "description": "A concise, 2-line professional explanation of what this specific notice type means."},
+        "whyText": {"type": "STRING", "description": "A paragraph explaining exactly why the user received this notice, based on the text."},
+        "fixSteps": {
+            "type": "OBJECT",
+            "properties": {
+                "agree": {"type": "STRING", "description": "The steps to take if the user agrees."},
+                "disagree": {"type": "STRING", "description": "The steps to take if the user disagrees."}
+            },
+            "required": ["agree", "disagree"]
+        },
+        "paymentOptions": {
+            "type": "OBJECT",
+            "properties": {
+                "online": {"type": "STRING", "description": "The URL for online payments, e.g., 'www.irs.gov/payments'."},
+                "mail": {"type": "STRING", "description": "Instructions for paying by mail."},
+                "plan": {"type": "STRING", "description": "The URL for setting up a payment plan, e.g., 'www.irs.gov/paymentplan'."}
+            },
+            "required": ["online", "mail", "plan"]
+        },
+        "helpInfo": {
+            "type": "OBJECT",
+            "properties": {
+                "contact": {"type": "STRING", "description": "The primary contact phone number for questions."},
+                "advocate": {"type": "STRING", "description": "Information about the Taxpayer Advocate Service, including their phone number."}
+            },
+            "required": ["contact", "advocate"]
+        }
+    },
+    "required": ["noticeType", "noticeFor", "address", "ssn", "amountDue", "payBy", "breakdown",
+                 "noticeMeaning", "whyText", "fixSteps", "paymentOptions", "helpInfo"]
+}
+
+# The static instructions go in systemInstruction, built once here rather than per request.
+GEMINI_SYSTEM_INSTRUCTION = {"parts": [{"text": (
+    "You are a meticulous tax notice analyst. Your task is to analyze the following text from an IRS notice "
+    "and extract the requested information into a single JSON object. Do not omit any fields. If a field's "
+    "information cannot be found, return an empty string \"\" for that value."
+)}]}
+
+GEMINI_GENERATION_CONFIG = {
+    "responseMimeType": "application/json",
+    "responseSchema": GEMINI_RESPONSE_SCHEMA
+}
+
+# Salts summary cache keys, so changing the prompt or schema stops serving summaries built for the old one.
+GEMINI_PROMPT_VERSION = hashlib.blake2b(
+    orjson.dumps([GEMINI_SYSTEM_INSTRUCTION, GEMINI_RESPONSE_SCHEMA]), digest_size=16
+).digest()
+
+GEMINI_BATCH_GENERATION_CONFIG = {
+    "responseMimeType": "application/json",
+    "responseSchema": {
+        "type": "ARRAY",
+        "items": {
+            "type": "OBJECT",
+            "properties": {"id": {"type": "INTEGER"}, "summary": GEMINI_RESPONSE_SCHEMA}
+        }
+    }
+}
+
+# One HTTP/2 client multiplexes concurrent Gemini calls over a shared keep-alive TLS connection,
+# with HPACK-compressed headers. The transport only retries failed connects; throttling
+# responses are retried by generate_json's backoff loop.
+GEMINI_CLIENT = httpx.Client(
+    transport=httpx.HTTPTransport(
+        http2=True, retries=3,
+        limits=httpx.Limits(max_keepalive_connections=16, max_connections=64)
+    ),
+    timeout=GEMINI_TIMEOUT,
+    # Payloads are pre-encoded with orjson, so the JSON content type is set once here.
+    headers={"Content-Type": "application/json"}
+)
+
+def create_db_pool():
+    """Builds the shared pool of PostgreSQL connections reused across requests."""
     if not all([DB_HOST, DB_PORT, DB_USER, DB_PASSWORD, DB_NAME]):
         print("FATAL ERROR: Database environment variables are not fully set.")
         return None
     try:
-        conn = psycopg2.connect(
+        return ThreadedConnectionPool(
+            DB_POOL_MIN, DB_POOL_MAX,
             host=DB_HOST, port=DB_PORT, user=DB_USER,
             password=DB_PASSWORD, dbname=DB_NAME, sslmode=DB_SSL_MODE,
             cursor_factory=RealDictCursor
         )
-        return conn
     except psycopg2.Error as e:
         print(f"DATABASE CONNECTION FAILED: {e}")
         return None
 
-def initialize_database():
-    """Creates or alters the users table to include new fields."""
-    conn = get_db_connection()
+# Each process builds its own pool on first use; connections must never be shared across a fork.
+POOL = None
+POOL_PID = None
+POOL_LOCK = threading.Lock()
+
+def get_db_pool():
+    """Returns this process's connection pool, rebuilding it after a fork or close."""
+    global POOL, POOL_PID
+    with POOL_LOCK:
+        if POOL is None or POOL.closed or POOL_PID != os.getpid():
+            POOL = create_db_pool()
+            POOL_PID = os.getpid()
+        return POOL
+
+def close_db_pool():
+    """Closes this process's pooled connections, e.g. in the Gunicorn master before forking."""
+    with POOL_LOCK:
+        if POOL and not POOL.closed and POOL_PID == os.getpid():
+            POOL.closeall()
+
+def prepare_statements(conn):
+    """Prepares PREPARED_STATEMENTS on a connection the first time it is checked out."""
+    if conn in PREPARED_CONNECTIONS:
+        return
+    try:
+        with conn.cursor() as cur:
+            # Prepared statements outlive a rollback, so clear any left by an earlier failed attempt.
+            cur.execute("DEALLOCATE ALL;")
+            for sql in PREPARED_STATEMENTS:
+                cur.execute(sql)
+        conn.commit()
+        PREPARED_CONNECTIONS.add(conn)
+    except psycopg2.Error as e:
+        print(f"PREPARE STATEMENTS ERROR: {e}")
+        # A stale connection is already closed, and rolling it back would raise InterfaceError.
+        if not conn.closed:
+            conn.rollback()
+        raise
+
+def get_db_connection():
+    """Checks a connection out of the pool; returns None if none is available."""
+    pool = get_db_pool()
+    if not pool:
+        return None
+    if not DB_POOL_SLOTS.acquire(timeout=DB_POOL_TIMEOUT):
+        print("DATABASE CONNECTION FAILED: Timed out waiting for a pooled connection.")
+        return None
+    try:
+        conn = pool.getconn()
+    except psycopg2.Error as e:
+        DB_POOL_SLOTS.release()
+        print(f"DATABASE CONNECTION FAILED: {e}")
+        return None
+    try:
+        prepare_statements(conn)
+    except psycopg2.Error:
+        # Hand the connection back closed so it does not keep its pool slot.
+        put_db_connection(conn, close=True)
+        return None
+    return conn
+
+def put_db_connection(conn, close=False):
+    """Returns a connection to the pool, discarding it if it is broken."""
     if not conn:
-        print("Could not initialize database, connection failed.")
         return
+    try:
+        if POOL and not POOL.closed:
+            POOL.putconn(conn, close=close or bool(conn.closed))
+    finally:
+        DB_POOL_SLOTS.release()
+
+@contextmanager
+def db_conn():
+    """Yields a pooled connection (or None) and always hands it back to the pool."""
+    conn = get_db_connection()
+    try:
+        yield conn
+    except psycopg2.Error:
+        put_db_connection(conn, close=True)
+        conn = None
+        raise
+    finally:
+        put_db_connection(conn)
+
+def normalize_email(email):
+    """Canonical form used to store and look up emails case-insensitively."""
+    return email.strip().lower()
+
+def verify_password(password_hash, password):
+    """Checks a password against an argon2 or legacy Werkzeug hash; returns (ok, needs_rehash)."""
+    if password_hash.startswith("$argon2"):
+        try:
+            PH.verify(password_hash, password)
+        except (VerificationError, InvalidHashError):
+            return False, False
+        return True, PH.check_needs_rehash(password_hash)
+    ok = check_password_hash(password_hash, password)
+    return ok, ok
 
+def login_blocked(client_ip):
+    """True once a client has used up its failed-login allowance for the current window."""
+    with LOGIN_FAILURES_LOCK:
+        return LOGIN_FAILURES.get(client_ip, 0) >= LOGIN_MAX_FAILURES
+
+def record_login_failure(client_ip):
+    """Counts a failed login; the window restarts with each failure."""
+    with LOGIN_FAILURES_LOCK:
+        LOGIN_FAILURES[client_ip] = LOGIN_FAILURES.get(client_ip, 0) + 1
+
+def rehash_password(conn, user_id, password):
+    """Replaces a user's stored hash with one using the current argon2 parameters."""
     try:
         with conn.cursor() as cur:
-            cur.execute("""
-                CREATE TABLE IF NOT EXISTS users (
-                    id SERIAL PRIMARY KEY,
-                    first_name VARCHAR(100) NOT NULL,
-                    last_name VARCHAR(100) NOT NULL,
-                    email VARCHAR(255) UNIQUE NOT NULL,
-                    password_hash VARCHAR(255) NOT NULL,
-                    created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
-                    dob DATE,
-                    mobile_number VARCHAR(25)
-                );
-            """)
+            cur.execute("UPDATE users SET password_hash = %s WHERE id = %s;", (PH.hash(password), user_id))
             conn.commit()
-            print("Database schema verified successfully.")
     except psycopg2.Error as e:
-        print(f"DATABASE SCHEMA ERROR: {e}")
-    finally:
-        if conn:
-            conn.close()
+        conn.rollback()
+        print(f"PASSWORD REHASH DB ERROR: {e}")
+
+def get_cached_summary(pdf_hash):
+    """Returns the stored summary for a previously processed PDF, if any."""
+    with SUMMARY_CACHE_LOCK:
+        entry = SUMMARY_CACHE.get(pdf_hash)
+    if entry is not None:
+        return entry[0]
+
+    with db_conn() as conn:
+        if not conn:
+            return None
+        try:
+            with conn.cursor() as cur:
+                cur.execute(
+                    "SELECT summary, "
+                    "extract(epoch FROM created_at + make_interval(secs => %s) - now()) AS ttl_left "
+                    "FROM summaries WHERE pdf_hash = %s AND created_at > now() - make_interval(secs => %s);",
+                    (SUMMARY_CACHE_TTL, pdf_hash, SUMMARY_CACHE_TTL)
+                )
+                row = cur.fetchone()
+        except psycopg2.Error as e:
+            print(f"SUMMARY CACHE READ ERROR: {e}")
+            return None
+    if not row:
+        return None
+    with SUMMARY_CACHE_LOCK:
+        SUMMARY_CACHE[pdf_hash] = (row['summary'], time.monotonic() + float(row['ttl_left']))
+    return row['summary']
+
+def store_cached_summary(pdf_hash, summary):
+    """Stores a summary keyed by the content hash of its PDF and purges expired rows."""
+    global SUMMARY_LAST_PURGE
+    with SUMMARY_CACHE_LOCK:
+        SUMMARY_CACHE[pdf_hash] = (summary, time.monotonic() + SUMMARY_CACHE_TTL)
+        now = time.monotonic()
+        purge = now - SUMMARY_LAST_PURGE >= SUMMARY_PURGE_INTERVAL
+        if purge:
+            SUMMARY_LAST_PURGE = now
+    with db_conn() as conn:
+        if not conn:
+            return
+        try:
+            with conn.cursor() as cur:
+                # An expired row for the same key is replaced rather than kept.
+                cur.execute(
+                    "INSERT INTO summaries (pdf_hash, summary) VALUES (%s, %s) "
+                    "ON CONFLICT (pdf_hash) DO UPDATE SET summary = EXCLUDED.summary, created_at = now();",
+                    (pdf_hash, Json(summary))
+                )
+                if purge:
+                    cur.execute(
+                        "DELETE FROM summaries WHERE created_at <= now() - make_interval(secs => %s);",
+                        (SUMMARY_CACHE_TTL,)
+                    )
+                conn.commit()
+        except psycopg2.Error as e:
+            print(f"SUMMARY CACHE WRITE ERROR: {e}")
 
 def extract_text_from_pdf(pdf_bytes):
-    """Extracts text from a PDF."""
+    """Extracts text from the first MAX_PDF_PAGES pages of a PDF."""
+    parts = []
     try:
         with fitz.open(stream=pdf_bytes, filetype="pdf") as doc:
-            return "".join(page.get_text() for page in doc)
+            for page in doc:
+                if page.number >= MAX_PDF_PAGES:
+                    break
+                parts.append(page.get_text("text", flags=PDF_TEXT_FLAGS))
+        return "".join(parts)
     except Exception as e:
         print(f"PDF EXTRACTION ERROR: {e}")
         return None
 
+def get_parse_pool():
+    """Returns this process's PDF parsing pool, creating it on first use."""
+    global PARSE_POOL
+    with PARSE_POOL_LOCK:
+        if PARSE_POOL is None:
+            # Forking a multi-threaded gthread worker can copy a held lock into the child, so workers
+            # come from a single-threaded forkserver instead; the DB pool is lazy, so importing this
+            # module there opens no connections.
+            ctx = multiprocessing.get_context("forkserver")
+            ctx.set_forkserver_preload([])
+            PARSE_POOL = ProcessPoolExecutor(max_workers=PDF_PARSE_PROCESSES, mp_context=ctx)
+        return PARSE_POOL
+
+def discard_parse_pool(pool, kill=False):
+    """Drops a failed parse pool so the next upload starts a fresh one."""
+    global PARSE_POOL
+    with PARSE_POOL_LOCK:
+        if PARSE_POOL is pool:
+            PARSE_POOL = None
+    if kill:
+        # A stuck worker would otherwise keep its slot; the executor has no public way to stop it.
+        for process in list((pool._processes or {}).values()):
+            process.kill()
+    pool.shutdown(wait=False, cancel_futures=True)
+
+def parse_pdf_in_pool(pdf_bytes, retry=True):
+    """Runs extract_text_from_pdf in the parse pool and waits for the result."""
+    pool = get_parse_pool()
+    try:
+        return pool.submit(extract_text_from_pdf, pdf_bytes).result(timeout=PDF_PARSE_TIMEOUT)
+    except FutureTimeoutError:
+        print("PDF EXTRACTION ERROR: Timed out.")
+        discard_parse_pool(pool, kill=True)
+        return None
+    except (BrokenProcessPool, CancelledError, RuntimeError) as e:
+        # If another request already discarded the pool (a timeout kill, or a crash it saw first),
+        # this upload was only queued behind the failure, so it gets one try on a fresh pool.
+        with PARSE_POOL_LOCK:
+            discarded_elsewhere = PARSE_POOL is not pool
+        if discarded_elsewhere and retry:
+            return parse_pdf_in_pool(pdf_bytes, retry=False)
+        # Otherwise a worker died on this file (e.g. MuPDF crashed on a malformed PDF).
+        print(f"PDF EXTRACTION ERROR: {e!r}")
+        discard_parse_pool(pool)
+        return None
+
+class GeminiError(Exception):
+    """Base class for failures talking to the Gemini API."""
+
+class RetryableGeminiError(GeminiError):
+    """A transient failure (network, throttling, 5xx) that may succeed if retried."""
+
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+class TerminalGeminiError(GeminiError):
+    """A failure that retrying will not fix, such as a rejected request or unusable reply."""
+
+def gemini_retry_delay(attempt, retry_after=None):
+    """Seconds to wait before retrying a throttled Gemini call."""
+    if retry_after:
+        try:
+            return min(float(retry_after), GEMINI_MAX_BACKOFF)
+        except ValueError:
+            pass
+    return min(2 ** attempt + random.random(), GEMINI_MAX_BACKOFF)
+
+def post_to_gemini(payload):
+    """Sends one generateContent request and returns the decoded response envelope."""
+    try:
+        with GEMINI_SEMAPHORE:
+            response = GEMINI_CLIENT.post(GEMINI_API_URL, content=orjson.dumps(payload))
+    except (httpx.TimeoutException, httpx.NetworkError, httpx.RemoteProtocolError) as e:
+        raise RetryableGeminiError(f"Request failed: {e}")
+    except httpx.HTTPError as e:
+        raise TerminalGeminiError(f"Request failed: {e}")
+
+    if response.status_code in GEMINI_RETRYABLE_STATUSES:
+        raise RetryableGeminiError(f"HTTP {response.status_code}", retry_after=response.headers.get("Retry-After"))
+    if response.status_code >= 400:
+        raise TerminalGeminiError(f"HTTP {response.status_code}: {response.text[:500]}")
+    try:
+        return orjson.loads(response.content)
+    except orjson.JSONDecodeError:
+        raise TerminalGeminiError("Response body is not JSON.")
+
+def generate_json(payload, est_tokens):
+    """Sends a payload under the rate limiter, retrying transient failures, and decodes the JSON reply.
+
+    Raises RetryableGeminiError once retries are exhausted and TerminalGeminiError otherwise.
+    """
+    for attempt in range(GEMINI_MAX_ATTEMPTS):
+        if not GEMINI_BUCKET.acquire(est_tokens, max_wait=GEMINI_MAX_QUEUE_WAIT):
+            raise RetryableGeminiError("Rate limit budget exhausted.", retry_after=str(GEMINI_MAX_BACKOFF))
+        try:
+            result = post_to_gemini(payload)
+            break
+        except RetryableGeminiError as e:
+            if attempt == GEMINI_MAX_ATTEMPTS - 1:
+                raise
+            delay = gemini_retry_delay(attempt, e.retry_after)
+            print(f"GEMINI API TRANSIENT ERROR ({e}), retrying in {delay:.1f}s.")
+            time.sleep(delay)
+
+    try:
+        summary_json_string = result['candidates'][0]['content']['parts'][0]['text']
+    except (KeyError, IndexError, TypeError):
+        raise TerminalGeminiError(f"Unexpected response structure: {str(result)[:500]}")
+    try:
+        return orjson.loads(summary_json_string)
+    except (orjson.JSONDecodeError, TypeError):
+        raise TerminalGeminiError(f"AI returned invalid JSON: {str(summary_json_string)[:500]}")
+
 def call_gemini_api(text):
     """Calls the Gemini API to summarize the extracted text."""
-    prompt = f"""
-    You are a meticulous tax notice analyst. Your task is to analyze the following text from an IRS notice and extract specific information into a single, well-structured JSON object. Do not omit any fields. If a field's information cannot be found, return an empty string "" for that value.
-
-    Based on the text provided, find and populate the following JSON structure:
-    {{
-      "noticeType": "The notice code, like 'CP23' or 'CP503C'",
-      "noticeFor": "The full name of the taxpayer, e.g., 'JAMES & KAREN Q. HINDS'",
-      "address": "The full address of the taxpayer, with newlines as \\n, e.g., '22 BOULDER STREET\\nHANSON, CT 00000-7253'",
-      "ssn": "The Social Security Number, masked, e.g., 'nnn-nn-nnnn'",
-      "amountDue": "The final total amount due as a string, e.g., '$500.73'",
-      "payBy": "The payment due date as a string, e.g., 'February 20, 2018'",
-      "breakdown": [
-        {{ "item": "The first line item in the billing summary", "amount": "Its corresponding amount" }},
-        {{ "item": "The second line item", "amount": "Its amount" }}
-      ],
-      "noticeMeaning": "A concise, 2-line professional explanation of what this specific notice type means.",
-      "whyText": "A paragraph explaining exactly why the user received this notice, based on the text.",
-      "fixSteps": {{
-        "agree": "A string explaining the steps to take if the user agrees.",
-        "disagree": "A string explaining the steps to take if the user disagrees."
-      }},
-      "paymentOptions": {{
-        "online": "The URL for online payments, e.g., 'www.irs.gov/payments'",
-        "mail": "Instructions for paying by mail.",
-        "plan": "The URL for setting up a payment plan, e.g., 'www.irs.gov/paymentplan'"
-      }},
-      "helpInfo": {{
-        "contact": "The primary contact phone number for questions.",
-        "advocate": "Information about the Taxpayer Advocate Service, including their phone number."
-      }}
-    }}
-
-    Here is the text to analyze:
-    ---
-    {text}
-    ---
+    text = text[:MAX_PROMPT_CHARS]
+    payload = {
+        "systemInstruction": GEMINI_SYSTEM_INSTRUCTION,
+        "contents": [{"parts": [{"text": f"Here is the text to analyze:\n---\n{text}\n---"}]}],
+        "generationConfig": GEMINI_GENERATION_CONFIG
+    }
+    return generate_json(payload, len(text) // 4 + 512)
+
+def call_gemini_api_batch(texts):
+    """Summarizes several notices in one Gemini call; returns a dict of summaries by list index."""
+    notices = orjson.dumps([{"id": i, "text": text} for i, text in enumerate(texts)]).decode()
+    prompt = (
+        "Here are several separate notices to analyze, as a JSON array of objects with an id and its text. "
+        "Analyze each notice independently and return a JSON array with one object per notice: "
+        "its id and the summary of that notice.\n" + notices
+    )
+    payload = {
+        "systemInstruction": GEMINI_SYSTEM_INSTRUCTION,
+        "contents": [{"parts": [{"text": prompt}]}],
+        "generationConfig": GEMINI_BATCH_GENERATION_CONFIG
+    }
+    result = generate_json(payload, sum(len(text) for text in texts) // 4 + 512 * len(texts))
+    if not isinstance(result, list):
+        raise TerminalGeminiError("Batch reply is not a JSON array.")
+    return {item['id']: item['summary'] for item in result
+            if isinstance(item, dict) and 'id' in item and 'summary' in item}
+
+class GeminiBatcher:
+    """Coalesces concurrent summarize calls into one Gemini request per batch window."""
+
+    def __init__(self, max_size, window):
+        self.max_size = max_size
+        self.window = window
+        self._queue = None
+        self._thread = None
+        self._executor = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def submit(self, text):
+        """Queues text for the next batch and blocks until its summary is ready."""
+        future = Future()
+        self._ensure_running().put((text, future))
+        return future.result()
+
+    def _ensure_running(self):
+        # The coalescer thread does not survive a fork, so each process starts its own.
+        with self._lock:
+            if self._thread is None or self._pid != os.getpid():
+                self._queue = queue.Queue()
+                # Batches in flight at once; each is already one rate-limited Gemini call.
+                self._executor = ThreadPoolExecutor(max_workers=self.max_size)
+                self._thread = threading.Thread(target=self._run, args=(self._queue,), daemon=True)
+                self._pid = os.getpid()
+                self._thread.start()
+            return self._queue
+
+    def _run(self, pending):
+        executor = self._executor
+        while True:
+            batch = [pending.get()]
+            deadline = time.monotonic() + self.window
+            while len(batch) < self.max_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(pending.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            # Dispatch off-thread so the next window starts collecting while this batch is in flight.
+            executor.submit(self._dispatch, batch, executor)
+
+    def _dispatch(self, batch, executor):
+        try:
+            if len(batch) == 1:
+                summaries = {0: call_gemini_api(batch[0][0])}
+            else:
+                try:
+                    summaries = call_gemini_api_batch([text for text, _ in batch])
+                except TerminalGeminiError as e:
+                    # Usually a reply cut off at the output limit; each notice still fits on its own.
+                    print(f"GEMINI BATCH ERROR ({e}), retrying notices one at a time.")
+                    summaries = {}
+        except Exception as e:
+            # Any failure belongs to the waiting requests, which re-raise it from future.result();
+            # summarize_notice only handles GeminiError, so anything else is reported as terminal.
+            if not isinstance(e, GeminiError):
+                e = TerminalGeminiError(f"Batch dispatch failed: {e!r}")
+            for _, future in batch:
+                future.set_exception(e)
+            return
+        for i, (text, future) in enumerate(batch):
+            if i in summaries:
+                future.set_result(summaries[i])
+            else:
+                executor.submit(self._dispatch, [(text, future)], executor)
+
+GEMINI_BATCHER = GeminiBatcher(GEMINI_BATCH_SIZE, GEMINI_BATCH_WINDOW)
+
+def summarize_text(text):
+    """Summarizes notice text, batching it with concurrent uploads when enabled.
+
+    Raises RetryableGeminiError once retries are exhausted and TerminalGeminiError otherwise.
     """
-    payload = {"contents": [{"parts": [{"text": prompt}]}]}
-    try:
-        response = requests.post(GEMINI_API_URL, json=payload, timeout=45)
-        response.raise_for_status()
-        result = response.json()
-        
-        if 'candidates' in result and result['candidates'] and 'content' in result['candidates'][0] and 'parts' in result['candidates'][0]['content'] and result['candidates'][0]['content']['parts']:
-            summary_json_string = result['candidates'][0]['content']['parts'][0]['text']
-            if summary_json_string.strip().startswith("```json"):
-                summary_json_string = summary_json_string.strip()[7:-3]
-            return summary_json_string
-        else:
-            print("GEMINI API ERROR: Unexpected response structure.")
-            return None
+    if GEMINI_BATCH_SIZE <= 1 or len(text) > GEMINI_BATCH_MAX_CHARS:
+        return call_gemini_api(text)
+    return GEMINI_BATCHER.submit(text)
 
-    except requests.exceptions.RequestException as e:
-        print(f"GEMINI API REQUEST FAILED: {e}")
-        return None
-    except Exception as e:
-        print(f"GEMINI API UNKNOWN ERROR: {e}")
-        return None
+@app.errorhandler(413)
+def request_too_large(e):
+    """Answers uploads over MAX_CONTENT_LENGTH in the API's JSON shape rather than Werkzeug's HTML page."""
+    return jsonify({"success": False, "message": "File too large."}), 413
 
 @app.route('/register', methods=['POST'])
 def register_user():
@@ -150,82 +742,98 @@ def register_user():
     if not data or not all(k in data for k in required_fields):
         return jsonify({"success": False, "message": "Missing required fields."}), 400
 
-    password_hash = generate_password_hash(data['password'])
-    conn = get_db_connection()
-    if not conn: return jsonify({"success": False, "message": "Database connection error."}), 500
+    email = normalize_email(data['email'])
+    password_hash = PH.hash(data['password'])
+    with db_conn() as conn:
+        if not conn: return jsonify({"success": False, "message": "Database connection error."}), 500
 
-    try:
-        with conn.cursor() as cur:
-            cur.execute("SELECT id FROM users WHERE email = %s;", (data['email'],))
-            if cur.fetchone():
-                return jsonify({"success": False, "message": "This email address is already in use."}), 409
-            
-            sql = """
-                INSERT INTO users (first_name, last_name, email, password_hash, dob, mobile_number) 
-                VALUES (%s, %s, %s, %s, %s, %s) 
-                RETURNING id, first_name, email;
-            """
-            cur.execute(sql, (data['firstName'], data['lastName'], data['email'], password_hash, data['dob'], data['mobileNumber']))
-            new_user = cur.fetchone()
-            conn.commit()
-            return jsonify({"success": True, "user": new_user}), 201
-    except psycopg2.Error as e:
-        print(f"REGISTRATION DB ERROR: {e}")
-        return jsonify({"success": False, "message": "An internal error occurred."}), 500
-    finally:
-        if conn:
-            conn.close()
+        try:
+            with conn.cursor(cursor_factory=psycopg2.extensions.cursor) as cur:
+                # A single upsert avoids the SELECT-then-INSERT round-trip and its race.
+                cur.execute("EXECUTE register_insert (%s, %s, %s, %s, %s, %s);",
+                            (data['firstName'], data['lastName'], email, password_hash, data['dob'], data['mobileNumber']))
+                row = cur.fetchone()
+                conn.commit()
+                if row is None:
+                    return jsonify({"success": False, "message": "This email address is already in use."}), 409
+                new_user = {"id": row[0], "first_name": row[1], "email": row[2]}
+                return jsonify({"success": True, "user": new_user}), 201
+        except psycopg2.Error as e:
+            print(f"REGISTRATION DB ERROR: {e}")
+            return jsonify({"success": False, "message": "An internal error occurred."}), 500
 
 @app.route('/login', methods=['POST'])
 def login_user():
     data = request.get_json()
     if not data or not all(k in data for k in ['email', 'password']):
         return jsonify({"success": False, "message": "Missing email or password."}), 400
-    
-    conn = get_db_connection()
-    if not conn: return jsonify({"success": False, "message": "Database connection error."}), 500
+    if login_blocked(request.remote_addr):
+        return jsonify({"success": False, "message": "Too many failed login attempts. Please try again later."}), 429, {"Retry-After": str(LOGIN_FAILURE_WINDOW)}
 
-    try:
-        with conn.cursor() as cur:
-            cur.execute("SELECT * FROM users WHERE email = %s;", (data['email'],))
-            user = cur.fetchone()
-            if user and check_password_hash(user['password_hash'], data['password']):
-                user_data = {"id": user['id'], "firstName": user['first_name'], "email": user['email']}
-                return jsonify({"success": True, "user": user_data}), 200
-            else:
-                return jsonify({"success": False, "message": "Invalid email or password."}), 401
-    except psycopg2.Error as e:
-        print(f"LOGIN DB ERROR: {e}")
-        return jsonify({"success": False, "message": "An internal error occurred."}), 500
-    finally:
-        if conn:
-            conn.close()
+    with db_conn() as conn:
+        if not conn: return jsonify({"success": False, "message": "Database connection error."}), 500
+
+        try:
+            with conn.cursor(cursor_factory=psycopg2.extensions.cursor) as cur:
+                cur.execute("EXECUTE login_select (%s);", (normalize_email(data['email']),))
+                user = cur.fetchone()
+                # Always run a verify so response time does not reveal whether the email exists.
+                ok, needs_rehash = verify_password(user[3] if user else DUMMY_HASH, data['password'])
+                if ok and user:
+                    if needs_rehash:
+                        rehash_password(conn, user[0], data['password'])
+                    user_data = {"id": user[0], "firstName": user[1], "email": user[2]}
+                    return jsonify({"success": True, "user": user_data}), 200
+                else:
+                    record_login_failure(request.remote_addr)
+                    return jsonify({"success": False, "message": "Invalid email or password."}), 401
+        except psycopg2.Error as e:
+            print(f"LOGIN DB ERROR: {e}")
+            return jsonify({"success": False, "message": "An internal error occurred."}), 500
 
 @app.route('/summarize', methods=['POST'])
 def summarize_notice():
+    if request.content_length and request.content_length > MAX_PDF_BYTES:
+        return jsonify({"success": False, "message": "File too large."}), 413
     if 'notice_pdf' not in request.files:
         return jsonify({"success": False, "message": "No PDF file provided."}), 400
     
     file = request.files['notice_pdf']
-    pdf_bytes = file.read()
-    raw_text = extract_text_from_pdf(pdf_bytes)
-    if not raw_text:
+    pdf_bytes = file.read(MAX_PDF_BYTES + 1)
+    if len(pdf_bytes) > MAX_PDF_BYTES:
+        return jsonify({"success": False, "message": "File too large."}), 413
+    # blake2b is only a cache key here, not a security boundary, and is cheaper than sha256.
+    pdf_hash = hashlib.blake2b(pdf_bytes, digest_size=16, salt=GEMINI_PROMPT_VERSION).hexdigest()
+    cached_summary = get_cached_summary(pdf_hash)
+    if cached_summary is not None:
+        return jsonify({"success": True, "summary": cached_summary}), 200
+
+    raw_text = parse_pdf_in_pool(pdf_bytes)
+    if raw_text is None:
         return jsonify({"success": False, "message": "Could not read text from PDF."}), 500
+    if len(raw_text.strip()) < MIN_PDF_TEXT_CHARS:
+        return jsonify({"success": False, "message": "PDF has no extractable text layer; OCR required."}), 422
 
-    summary_json = call_gemini_api(raw_text)
-    if not summary_json:
-        return jsonify({"success": False, "message": "Failed to get summary from AI."}), 500
-        
     try:
-        summary_data = json.loads(summary_json)
-        return jsonify({"success": True, "summary": summary_data}), 200
-    except json.JSONDecodeError:
-        print(f"AI returned invalid JSON: {summary_json}")
-        return jsonify({"success": False, "message": "AI returned an invalid format."}), 500
-
-# This block ensures the database table is ready when the app starts.
-with app.app_context():
-    initialize_database()
+        summary_data = summarize_text(raw_text)
+    except RetryableGeminiError as e:
+        print(f"GEMINI API UNAVAILABLE: {e}")
+        return (jsonify({"success": False, "message": "The AI service is busy. Please try again shortly."}),
+                503, {"Retry-After": e.retry_after or str(GEMINI_MAX_BACKOFF)})
+    except TerminalGeminiError as e:
+        print(f"GEMINI API ERROR: {e}")
+        return jsonify({"success": False, "message": "Failed to get summary from AI."}), 502
+
+    store_cached_summary(pdf_hash, summary_data)
+    return jsonify({"success": True, "summary": summary_data}), 200
+
+# Schema changes normally ship through `python -m migrate` as a deploy step. Hosts without a
+# release phase can set RUN_MIGRATIONS=1 instead; with preload_app this runs once, in the master.
+# Parse pool workers import this module too; only the serving process may migrate.
+if os.getenv("RUN_MIGRATIONS") == "1" and multiprocessing.current_process().name == "MainProcess":
+    # Like `python -m migrate`, refuse to start on a missing or partial schema.
+    if not run_migrations():
+        raise SystemExit(1)
 
 if __name__ == '__main__':
     # Render uses the PORT environment variable to bind the server.